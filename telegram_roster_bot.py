@@ -1,21 +1,27 @@
 import pandas as pd
-import requests
-from io import StringIO
-import google.generativeai as genai
+import httpx
+from io import BytesIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters, ContextTypes
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler, ConversationHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 import logging
 import os
-import gspread
-from google.oauth2.service_account import Credentials
 from typing import Optional, Tuple, Dict, List
 import json
+import time
+import asyncio
+import re
+import hashlib
+import csv
+import codecs
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # Optional: Telegram responses are parsed with the standard json module instead
+    orjson = None
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # Configuration - Load from environment variables
@@ -26,22 +32,124 @@ C1_C5_SPREADSHEET_ID = os.getenv("C1_C5_SPREADSHEET_ID")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 MEDICS_REFERENCE_LIST = os.getenv("MEDICS_REFERENCE_LIST")  # Reference list of medics with full names and ranks
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL; when set, updates are pushed by Telegram instead of polled
+PORT = int(os.getenv("PORT", 8443))  # Port the webhook server listens on
+
+GEMINI_MODEL = 'gemini-2.5-flash'
 
 CURRENT_MONTH = 'OCT'
+CSV_CACHE_TTL = 60  # Seconds a downloaded roster CSV is reused before re-fetching
+HTTP_TIMEOUT = 10  # Seconds for outbound Google Sheets requests
+HTTP_CONNECT_RETRIES = 2  # Extra attempts when connecting to Google fails
+STREAM_EDIT_INTERVAL = 1.5  # Minimum seconds between progressive Telegram edits (keeps concurrent chats under edit limits)
+CSV_ROWS_USED = 21  # Header rows plus roster rows; nothing below this is read
+CSV_COLS_USED = 34  # Name column through day 31 (column 33); nothing to the right is read
+PARADE_STATE_CACHE_TTL = 600  # Seconds a finished parade state is reused for unchanged sheet contents and date
+PARTIAL_PARADE_STATE_CACHE_TTL = 30  # Same, for a parade state built without leave info (the leave sheet failed)
+SHEET_NAMES_CACHE_TTL = 1800  # Seconds a spreadsheet's tab listing is reused (tabs change about monthly)
+LEAVE_TRACKER_CACHE_TTL = 120  # Seconds a loaded leave sheet (data and merges) is reused
+CONTEXT_CACHE_TTL = 6 * 3600  # Seconds Gemini keeps a cached system instruction
+CONTEXT_CACHE_REFRESH_MARGIN = 300  # Recreate the cache this many seconds before it expires
+CONTEXT_CACHE_RETRY_INTERVAL = 60  # Seconds to send instructions inline after a transient cache creation failure
+PARADE_THINKING_BUDGET = 1024  # The fallback runs on irregular rosters, where counting and sorting need reasoning
+PARADE_MAX_OUTPUT_TOKENS = 800 + PARADE_THINKING_BUDGET  # The filled template is ~400-600 tokens, plus thinking
+CORRECTION_MAX_OUTPUT_TOKENS = 700  # Corrected output is the same length as the parade state passed in
 # Conversation states
 SELECTING_DATE, SELECTING_MAIN_SHEET, SELECTING_C1C5_SHEET = range(3)
 
+# Parsed CSVs keyed by export URL: {url: (fetched_at, df, content_digest)}, with one lock per URL so
+# different sheets download in parallel while repeat requests for one sheet wait for a single fetch
+_CSV_CACHE: Dict[str, Tuple[float, pd.DataFrame, bytes]] = {}
+_CSV_CACHE_LOCKS: Dict[str, asyncio.Lock] = {}
+
+# Sheet listings keyed by spreadsheet ID: {spreadsheet_id: (fetched_at, sheets)}
+_SHEET_NAMES_CACHE: Dict[str, Tuple[float, List[dict]]] = {}
+
+# Work shared between concurrent requests runs as a task in the *_INFLIGHT dicts (and _GEMINI_CLIENT_TASK);
+# callers await it through asyncio.shield, so one caller giving up doesn't cancel it for the others
+
+# Loaded leave sheets keyed by (spreadsheet_id, sheet_id): {key: (loaded_at, tracker)}
+_LEAVE_TRACKER_CACHE: Dict[Tuple[str, int], Tuple[float, 'LeaveTracker']] = {}
+_LEAVE_TRACKER_INFLIGHT: Dict[Tuple[str, int], asyncio.Task] = {}
+
+# Parade state generations keyed by (main_sheet_id, c1c5_sheet_id, date, sheet_data_hash)
+_PARADE_STATE_INFLIGHT: Dict[tuple, asyncio.Task] = {}
+# Finished parade states: {key: (expires_at, parade_state)}
+_PARADE_STATE_CACHE: Dict[tuple, Tuple[float, str]] = {}
+_PARADE_STATE_CACHE_STATS = {'hits': 0, 'misses': 0, 'joins': 0}
+
+# Gemini context caches keyed by system instruction: {instruction: (refresh_at, cache_name or None to send inline)}
+_CONTEXT_CACHES: Dict[str, Tuple[float, Optional[str]]] = {}
+_CONTEXT_CACHES_LOCK = asyncio.Lock()
+
+# Task creating the Gemini client in a worker thread (see start_gemini_client)
+_GEMINI_CLIENT_TASK: Optional[asyncio.Task] = None
+
+# Parade state rules used to build the message locally
+HOLDING_STRENGTH = 17  # 12 medics + 1 supply assistant + 2 MO + 2 SM
+TOTAL_MEDICS = 12
+RANK_CAT = pd.CategoricalDtype(
+    ["CPT", "LTA", "ME3", "ME2", "ME1", "2SG", "3SG", "CFC", "CPL", "LCP", "PTE"], ordered=True
+)  # Highest to lowest; unknown ranks become NaN
+MEDIC_DUTY_PATTERN = re.compile(r'^M-?([1-4])\b')
+WEEKDAYS = ("MON", "TUE", "WED", "THU", "FRI", "SAT", "SUN")
+ABSENT_DUTY_PATTERN = re.compile(r'\b(MA|DO|OIL|OFF|COURSE|MC|OSL|LL|COMPASSIONATE LEAVE)\b')
+
+PARADE_STATE_TEMPLATE = """PARADE STATE FOR {date} {month} 2025 {day}
+
+Holding Strength: {holding}
+Present Strength: {present}/{holding}
+Medic Strength: {medic}/{total_medics}
+
+MO: 
+CPT (DR) CHONG:
+CPT (DR) ANDRE: 
+
+
+SM:
+ME3 KARRIE:
+ME2 BRYAN:
+
+
+Medics: 
+{absent}
+
+
+M1: {m1}
+M2: {m2}
+M3: {m3}
+M4: {m4}
+
+
+C1: 
+C5: 
+
+Additional:
+{additional}
+
+
+BASE E (CPC): TBC
+SUPPLY ASSISTANT
+CFC HOVAN: 
+
+Flying Hours: TBC"""
+
 class LeaveTracker:
     """Track leave status from Google Sheets (optimized with single API call)"""
     
-    def __init__(self, spreadsheet_id: str, sheet_id: int, credentials_json: str = None):
+    def __init__(self, spreadsheet_id: str, sheet_id: int, credentials_json: str = None, sheet_title: Optional[str] = None):
         """Initialize Leave Tracker with service account credentials and specific sheet ID
         
         Args:
             spreadsheet_id: The Google Spreadsheet ID
             sheet_id: The specific sheet ID (gid) to open
             credentials_json: Service account credentials as JSON string
+            sheet_title: The sheet's title, if already known (saves looking it up by ID)
         """
+        # Imported on first use to keep them off the bot's startup path
+        import gspread
+        from google.oauth2.service_account import Credentials
+        
         scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
         
         if not credentials_json:
@@ -63,15 +171,6 @@ class LeaveTracker:
             raise
         
         self.client = gspread.authorize(creds)
-        spreadsheet = self.client.open_by_key(spreadsheet_id)
-        
-        # Open the specific sheet by ID
-        try:
-            self.sheet = spreadsheet.get_worksheet_by_id(sheet_id)
-            logger.info(f"Opened sheet with ID: {sheet_id}, Title: {self.sheet.title}")
-        except gspread.WorksheetNotFound:
-            logger.error(f"Sheet with ID {sheet_id} not found. Using first sheet as fallback.")
-            self.sheet = spreadsheet.get_worksheet(0)
         
         # Column and row configuration
         self.NAME_COLUMN = 2  # Column B
@@ -79,34 +178,86 @@ class LeaveTracker:
         self.START_ROW = 6     # First person's row
         self.END_ROW = 17      # Last person's row
         
-        # Leave types to detect
-        self.LEAVE_TYPES = ['MC', 'LL', 'OSL', 'COMPASSIONATE LEAVE', 'COURSE']
+        # Leave types to detect, matched anywhere in a cell in one case-insensitive regex scan
+        self.LEAVE_TYPES = ('MC', 'LL', 'OSL', 'COMPASSIONATE LEAVE', 'COURSE')
+        self.LEAVE_PATTERN = re.compile('|'.join(map(re.escape, self.LEAVE_TYPES)), re.IGNORECASE)
+        
+        # PERFORMANCE OPTIMIZATION: Load the sheet's properties, merged ranges and data in one API call
+        sheet_data = self._fetch_sheet(spreadsheet_id, sheet_title) if sheet_title else None
+        if sheet_data is None or sheet_data['properties']['sheetId'] != sheet_id:
+            # Title unknown or stale, so resolve it from the sheet ID first
+            metadata = self.client.request(
+                'get', gspread.urls.SPREADSHEET_URL % spreadsheet_id, params={'fields': 'sheets.properties(sheetId,title)'}
+            ).json()
+            titles = {sheet['properties']['sheetId']: sheet['properties']['title'] for sheet in metadata['sheets']}
+            sheet_title = titles.get(sheet_id)
+            if sheet_title is None:
+                logger.error(f"Sheet with ID {sheet_id} not found. Using first sheet as fallback.")
+                sheet_title = metadata['sheets'][0]['properties']['title']
+            sheet_data = self._fetch_sheet(spreadsheet_id, sheet_title)
+        logger.info(f"Opened sheet with ID: {sheet_data['properties']['sheetId']}, Title: {sheet_data['properties']['title']}")
         
         # Cache merged ranges for the specific sheet
-        metadata = self.sheet.spreadsheet.fetch_sheet_metadata()
-        # Find the merges for this specific sheet
-        for sheet_metadata in metadata['sheets']:
-            if sheet_metadata['properties']['sheetId'] == sheet_id:
-                self.merged_ranges = sheet_metadata.get('merges', [])
-                logger.info(f"Found {len(self.merged_ranges)} merged ranges in sheet")
-                break
-        else:
-            self.merged_ranges = []
-            logger.warning(f"No merged ranges found for sheet ID {sheet_id}")
-        
-        # PERFORMANCE OPTIMIZATION: Load all data in one API call
-        # Get all values from rows 6-17 (all columns)
-        range_notation = f'A{self.START_ROW}:Z{self.END_ROW}'
-        logger.info(f"Loading all data from range: {range_notation}")
-        self.all_data = self.sheet.get(range_notation)
+        self.merged_ranges = sheet_data.get('merges', [])
+        logger.info(f"Found {len(self.merged_ranges)} merged ranges in sheet")
+        
+        # Rows 6-17, from column A through day 31 (column AH), as formatted strings
+        row_data = sheet_data['data'][0].get('rowData', []) if sheet_data.get('data') else []
+        self.all_data = [[cell.get('formattedValue', '') for cell in row.get('values', [])] for row in row_data]
         logger.info(f"Loaded {len(self.all_data)} rows of data")
+        
+        # Index names once so each lookup is a dict hit instead of a scan (first occurrence wins)
+        self._name_to_row: Dict[str, int] = {}
+        for row in range(self.START_ROW, self.END_ROW + 1):
+            cell_value = self._get_cell_value(row, self.NAME_COLUMN)
+            if cell_value and cell_value.strip():
+                self._name_to_row.setdefault(cell_value.strip(), row)
+        
+        # Resolve every leave merge once into {row: [leave info for day 1..31]} so queries are plain indexing
+        self._leave_lookup: Dict[int, List[Optional[Tuple[str, int, int]]]] = {
+            row: [None] * 31 for row in range(self.START_ROW, self.END_ROW + 1)
+        }
+        for merge in self.merged_ranges:
+            start_col = merge['startColumnIndex'] + 1
+            start_day = start_col - (self.DAY_1_COLUMN - 1)
+            end_day = merge['endColumnIndex'] - (self.DAY_1_COLUMN - 1)
+            
+            for row_idx in range(max(merge['startRowIndex'] + 1, self.START_ROW), min(merge['endRowIndex'], self.END_ROW) + 1):
+                cell_value = self._get_cell_value(row_idx, start_col)
+                if not self._is_leave_cell(cell_value):
+                    continue
+                days = self._leave_lookup[row_idx]
+                for day in range(max(start_day, 1), min(end_day, 31) + 1):
+                    # Earlier merges take precedence, matching a first-match scan
+                    if days[day - 1] is None:
+                        days[day - 1] = (cell_value.strip(), start_day, end_day)
+    
+    def _fetch_sheet(self, spreadsheet_id: str, sheet_title: str) -> Optional[dict]:
+        """Fetch a sheet's properties, merges and roster cells in a single request (None if no sheet has that title)
+        
+        A plain GET with a ranges filter only needs the spreadsheets.readonly scope.
+        """
+        import gspread
+        
+        cell_range = f"A{self.START_ROW}:{gspread.utils.rowcol_to_a1(self.END_ROW, self.DAY_1_COLUMN + 30)}"
+        params = {
+            'ranges': gspread.utils.absolute_range_name(sheet_title, cell_range),
+            'includeGridData': 'true',
+            'fields': 'sheets(properties(sheetId,title),merges,data(rowData(values(formattedValue))))',
+        }
+        try:
+            response = self.client.request('get', gspread.urls.SPREADSHEET_URL % spreadsheet_id, params=params)
+        except gspread.exceptions.APIError as e:
+            # An unknown sheet title makes the range unparseable
+            if e.response.status_code == 400:
+                return None
+            raise
+        sheets = response.json().get('sheets', [])
+        return sheets[0] if sheets else None
     
     def _is_leave_cell(self, cell_value: str) -> bool:
         """Check if cell contains any leave type"""
-        if not cell_value:
-            return False
-        cell_upper = cell_value.upper()
-        return any(leave_type in cell_upper for leave_type in self.LEAVE_TYPES)
+        return bool(cell_value) and self.LEAVE_PATTERN.search(cell_value) is not None
     
     def _get_cell_value(self, row: int, col: int) -> str:
         """Get cell value from loaded data (fast, no API call)"""
@@ -120,12 +271,8 @@ class LeaveTracker:
         return ""
     
     def _find_person_row(self, name: str) -> Optional[int]:
-        """Find the row number for a person by name (uses loaded data, no API call)"""
-        for row in range(self.START_ROW, self.END_ROW + 1):
-            cell_value = self._get_cell_value(row, self.NAME_COLUMN)
-            if cell_value and cell_value.strip() == name.strip():
-                return row
-        return None
+        """Find the row number for a person by name (uses the name index, no API call)"""
+        return self._name_to_row.get(name.strip())
     
     def check_leave_on_day(self, row_idx: int, day: int) -> Optional[Tuple[str, int, int]]:
         """
@@ -138,28 +285,10 @@ class LeaveTracker:
         Returns:
             Tuple of (cell_value, start_day, end_day) if on leave, None otherwise
         """
-        # Check all merged ranges for this row
-        for merge in self.merged_ranges:
-            start_row = merge['startRowIndex'] + 1
-            end_row = merge['endRowIndex']
-            start_col = merge['startColumnIndex'] + 1
-            end_col = merge['endColumnIndex']
-            
-            # Check if this merge affects the person's row
-            if start_row <= row_idx <= end_row:
-                # Calculate day range
-                start_day = start_col - (self.DAY_1_COLUMN - 1)
-                end_day = end_col - (self.DAY_1_COLUMN - 1)
-                
-                # Check if the queried day falls within this range
-                if start_day <= day <= end_day:
-                    # Use cached data to get cell value
-                    cell_value = self._get_cell_value(row_idx, start_col)
-                    
-                    if self._is_leave_cell(cell_value):
-                        return (cell_value.strip(), start_day, end_day)
-        
-        return None
+        days = self._leave_lookup.get(row_idx)
+        if days is None or not 1 <= day <= 31:
+            return None
+        return days[day - 1]
     
     def check_people_on_day(self, names: List[str], day: int) -> Dict[str, Optional[Tuple[str, int, int]]]:
         """
@@ -185,10 +314,14 @@ class LeaveTracker:
         
         return results
 
-def get_sheet_names(spreadsheet_id, api_key):
-    """Fetch all sheet names and IDs from a Google Spreadsheet."""
+async def get_sheet_names(client, spreadsheet_id, api_key):
+    """Fetch all sheet names and IDs from a Google Spreadsheet (cached for SHEET_NAMES_CACHE_TTL seconds)."""
+    cached = _SHEET_NAMES_CACHE.get(spreadsheet_id)
+    if cached and time.monotonic() - cached[0] < SHEET_NAMES_CACHE_TTL:
+        return cached[1]
+    
     url = f'https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}?key={api_key}'
-    response = requests.get(url)
+    response = await client.get(url)
     
     if response.status_code == 200:
         data = response.json()
@@ -198,6 +331,7 @@ def get_sheet_names(spreadsheet_id, api_key):
                 'name': sheet['properties']['title'],
                 'id': sheet['properties']['sheetId']
             })
+        _SHEET_NAMES_CACHE[spreadsheet_id] = (time.monotonic(), sheets)
         return sheets
     else:
         raise Exception(f"Error fetching sheets: {response.status_code}")
@@ -206,62 +340,169 @@ def build_csv_url(spreadsheet_id, sheet_id):
     """Build CSV export URL from spreadsheet ID and sheet ID."""
     return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={sheet_id}"
 
-def fetch_csv_from_url(url):
+async def fetch_csv_from_url(client, url):
     """Fetch CSV content from URL without storing the file."""
-    response = requests.get(url)
-    response.raise_for_status()
-    return StringIO(response.text)
+    # Stream the body straight into the buffer pandas reads from; it decodes in C without an intermediate Python str
+    csv_data = BytesIO()
+    async with client.stream('GET', url, follow_redirects=True) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            csv_data.write(chunk)
+    csv_data.seek(0)
+    return csv_data
+
+async def get_dataframe(client, url, ttl=CSV_CACHE_TTL):
+    """Return the parsed CSV at url, re-fetching only once the cached copy is older than ttl seconds."""
+    async with _CSV_CACHE_LOCKS.setdefault(url, asyncio.Lock()):
+        cached = _CSV_CACHE.get(url)
+        if cached and time.monotonic() - cached[0] < ttl:
+            logger.info(f"Using cached CSV for {url}")
+            return cached[1]
+        
+        csv_data = await fetch_csv_from_url(client, url)
+        content = csv_data.getvalue()
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        
+        # Google's CSV export pads every row to the sheet width, so the first record gives the column count
+        width = len(next(csv.reader(codecs.iterdecode(BytesIO(content), 'utf-8')), []))
+        
+        # Every cell is a label, so skip per-column type inference; blanks still come back as NaN
+        df = pd.read_csv(
+            csv_data,
+            header=None,
+            nrows=CSV_ROWS_USED,
+            usecols=range(max(min(width, CSV_COLS_USED), 1)),
+            encoding='utf-8',
+            engine='c',
+            dtype=str,
+        )
+        _CSV_CACHE[url] = (time.monotonic(), df, digest)
+        return df
+
+async def get_sheet_data_hash(client, *urls):
+    """Return a hash of the current CSV contents at urls, loading them through the CSV cache."""
+    await asyncio.gather(*(get_dataframe(client, url) for url in urls))
+    sheet_hash = hashlib.blake2b(digest_size=16)
+    for url in urls:
+        sheet_hash.update(_CSV_CACHE[url][2])
+    return sheet_hash.hexdigest()
 
 def extract_date_info(df, col_idx):
     """Extract date and day information from a column."""
     date = col_idx - 2
-    day = df.iloc[2, col_idx]
+    day = df.iat[2, col_idx]  # Scalar accessor: skips iloc's general indexing machinery
     return date, day
 
 def prepare_roster_data(df, target_date_col):
     """Extract relevant roster data for the target date."""
-    roster_df = df.iloc[5:18, [1, target_date_col]].copy()
+    # A list of columns makes iloc return a new frame, so the leave update can't touch the cached CSV
+    roster_df = df.iloc[5:18, [1, target_date_col]]
     roster_df.columns = ['Name', 'Duty']
-    month = df.iloc[1, 1]
+    month = df.iat[1, 1]
     return roster_df, month
 
-def update_roster_with_leave_info(roster_df, date, month, spreadsheet_id, sheet_id, credentials_json):
+def load_leave_tracker(spreadsheet_id, sheet_id, credentials_json, sheet_title=None):
     """
-    Update roster with leave information for personnel with NaN duty
+    Load the leave tracker for a sheet (blocking: authorises and reads the sheet through gspread)
     
     Args:
-        roster_df: DataFrame with Name and Duty columns
-        date: Day number (1-31)
-        month: Month name (e.g., "OCTOBER")
         spreadsheet_id: Google Sheets spreadsheet ID
         sheet_id: Specific sheet ID (gid) to check for leave
         credentials_json: Service account credentials JSON string
+        sheet_title: The sheet's title, if already known
         
     Returns:
-        Updated DataFrame with leave information
+        LeaveTracker, or None if leave tracking is unavailable
     """
     try:
         # Check if credentials are provided
         if not credentials_json:
             logger.warning("GOOGLE_CREDENTIALS_JSON not set. Skipping leave tracking.")
-            return roster_df
-        
-        # Find people with NaN duty (no specific assignment)
-        names_to_check = roster_df[roster_df['Duty'].isna()]['Name'].tolist()
-        
-        if not names_to_check:
-            logger.info("No personnel with NaN duty to check for leave")
-            return roster_df
-        
-        # Remove last entry if it exists (often a summary row)
-        if names_to_check:
-            names_to_check = names_to_check[:-1] if len(names_to_check) > 1 else names_to_check
-        
-        logger.info(f"Checking leave for {len(names_to_check)} personnel: {names_to_check}")
+            return None
         
         # Initialize leave tracker with specific sheet ID
-        tracker = LeaveTracker(spreadsheet_id, sheet_id, credentials_json)
+        return LeaveTracker(spreadsheet_id, sheet_id, credentials_json, sheet_title)
+        
+    except ValueError as e:
+        # Specific error for JSON/credentials issues
+        logger.error(f"Credentials error: {e}")
+        logger.error("Please check GOOGLE_CREDENTIALS_JSON environment variable formatting")
+        logger.error("See GOOGLE_CREDENTIALS_JSON Troubleshooting Guide for help")
+        logger.warning("Continuing without leave information")
+        return None
+    except Exception as e:
+        logger.error(f"Error checking leave status: {e}")
+        logger.warning("Continuing without leave information")
+        return None
+
+async def get_leave_tracker(spreadsheet_id, sheet_id, credentials_json, sheet_title=None):
+    """Return the leave tracker for a sheet, reusing one loaded within the last LEAVE_TRACKER_CACHE_TTL seconds."""
+    key = (spreadsheet_id, sheet_id)
+    cached = _LEAVE_TRACKER_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < LEAVE_TRACKER_CACHE_TTL:
+        logger.info(f"Using cached leave tracker for sheet {sheet_id}")
+        return cached[1]
+    
+    # Concurrent requests for the same sheet share one load
+    task = _LEAVE_TRACKER_INFLIGHT.get(key)
+    if task is None:
+        # gspread is blocking, so run it in a worker thread to keep the event loop free
+        task = asyncio.ensure_future(asyncio.to_thread(load_leave_tracker, spreadsheet_id, sheet_id, credentials_json, sheet_title))
+        _LEAVE_TRACKER_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _LEAVE_TRACKER_INFLIGHT.pop(key, None))
+    else:
+        logger.info(f"Joining in-flight leave tracker load for sheet {sheet_id}")
+    
+    tracker = await asyncio.shield(task)
+    if tracker is not None:  # Failures aren't cached, so the next request tries again
+        _LEAVE_TRACKER_CACHE[key] = (time.monotonic(), tracker)
+    return tracker
+
+def get_names_to_check(names, duties):
+    """Names to look up in the leave sheet: named personnel with NaN duty (no specific assignment)."""
+    names_to_check = [name for name, duty in zip(names, duties) if pd.isna(duty)]
+    
+    # Remove last entry if it exists (often a summary row)
+    if len(names_to_check) > 1:
+        names_to_check = names_to_check[:-1]
+    
+    # Rows without a name (blank or summary rows) can't be looked up in the leave sheet
+    return [name for name in names_to_check if isinstance(name, str)]
+
+def has_unassigned_personnel(roster_df):
+    """Whether anyone would be looked up in the leave sheet, i.e. whether leave needs checking at all."""
+    return bool(get_names_to_check(roster_df['Name'].tolist(), roster_df['Duty'].tolist()))
+
+def update_roster_with_leave_info(roster_df, date, month, tracker):
+    """
+    Update roster with leave information for personnel with NaN duty
+    
+    Args:
+        roster_df: DataFrame with Name and Duty columns
+        date: Day number (1-31)
+        month: Month name (e.g., "OCTOBER")
+        tracker: Loaded LeaveTracker, or None to leave the roster unchanged
         
+    Returns:
+        Tuple of (updated DataFrame, whether leave information was actually checked)
+    """
+    if tracker is None:
+        return roster_df, False
+    
+    # Work on plain lists: the roster is ~13 rows, where per-operation pandas overhead dominates
+    names = roster_df['Name'].tolist()
+    duties = roster_df['Duty'].tolist()
+    
+    # Find people with NaN duty (no specific assignment)
+    names_to_check = get_names_to_check(names, duties)
+    
+    if not names_to_check:
+        logger.info("No personnel with NaN duty to check for leave")
+        return roster_df, True
+    
+    logger.info(f"Checking leave for {len(names_to_check)} personnel: {names_to_check}")
+    
+    try:
         # Check leave status
         results = tracker.check_people_on_day(names_to_check, date)
         
@@ -270,43 +511,217 @@ def update_roster_with_leave_info(roster_df, date, month, spreadsheet_id, sheet_
         
         if on_leave:
             logger.info(f"Found {len(on_leave)} personnel on leave")
+            leave_infos = {}
             for name, result in on_leave.items():
                 leave_reason, start_day, end_day = result
-                leave_info = f"{leave_reason} ({start_day} {month} - {end_day} {month})"
-                roster_df.loc[roster_df['Name'] == name, 'Duty'] = leave_info
-                logger.info(f"Updated {name}: {leave_info}")
+                leave_infos[name] = f"{leave_reason} ({start_day} {month} - {end_day} {month})"
+                logger.info(f"Updated {name}: {leave_infos[name]}")
+            roster_df['Duty'] = [leave_infos.get(name, duty) for name, duty in zip(names, duties)]
         else:
             logger.info("No personnel on leave")
-        
-        return roster_df
-        
-    except ValueError as e:
-        # Specific error for JSON/credentials issues
-        logger.error(f"Credentials error: {e}")
-        logger.error("Please check GOOGLE_CREDENTIALS_JSON environment variable formatting")
-        logger.error("See GOOGLE_CREDENTIALS_JSON Troubleshooting Guide for help")
-        logger.warning("Continuing without leave information")
-        return roster_df
     except Exception as e:
         logger.error(f"Error checking leave status: {e}")
         logger.warning("Continuing without leave information")
-        return roster_df
+        return roster_df, False
+    
+    return roster_df, True
+
+def build_parade_state(roster_df, date, day, month):
+    """Build the parade state message directly from the roster.
+    
+    Returns:
+        The parade state text, or None if a name has no known rank or a duty code is not recognised
+    """
+    roster = roster_df.dropna(subset=['Name']).copy()
+    roster['Name'] = roster['Name'].astype(str).str.strip()
+    roster = roster[roster['Name'] != '']
+    
+    # CPC is external staff: only shown alongside the medic covering their duty
+    is_cpc = roster['Name'].str.upper() == 'CPC'
+    cpc_duties = roster.loc[is_cpc, 'Duty'].dropna().astype(str).str.strip().str.upper()
+    cpc_slots = {match.group(1) for match in map(MEDIC_DUTY_PATTERN.match, cpc_duties) if match}
+    roster = roster[~is_cpc]
+    
+    roster['rank'] = roster['Name'].str.split().str[0].str.upper().astype(RANK_CAT)
+    if roster['rank'].isna().any():
+        logger.info(f"Unknown rank for: {roster.loc[roster['rank'].isna(), 'Name'].tolist()}")
+        return None
+    roster = roster.sort_values('rank', kind='stable')
+    
+    absent = []
+    additional = []
+    slots = {n: [] for n in '1234'}
+    for name, duty in zip(roster['Name'], roster['Duty']):
+        if pd.isna(duty) or not str(duty).strip():
+            additional.append(name)
+            continue
+        duty = str(duty).strip()
+        duty_upper = duty.upper()
+        medic_match = MEDIC_DUTY_PATTERN.match(duty_upper)
+        if medic_match:
+            # AM duty is listed before PM duty
+            shift = 0 if 'AM' in duty_upper else 2 if 'PM' in duty_upper else 1
+            slots[medic_match.group(1)].append((shift, name))
+        elif ABSENT_DUTY_PATTERN.search(duty_upper):
+            absent.append(f"{name}: {duty}")
+        else:
+            logger.info(f"Unrecognised duty '{duty}' for {name}")
+            return None
+    
+    slot_text = {}
+    for n, entries in slots.items():
+        names = [name for _, name in sorted(entries, key=lambda entry: entry[0])]
+        if n in cpc_slots:
+            names.append("CPC")
+        slot_text[f"m{n}"] = " / ".join(names)
+    
+    return PARADE_STATE_TEMPLATE.format(
+        date=date,
+        month=month,
+        day=day,
+        holding=HOLDING_STRENGTH,
+        present=HOLDING_STRENGTH - len(absent),
+        medic=TOTAL_MEDICS - len(absent),
+        total_medics=TOTAL_MEDICS,
+        absent="\n".join(absent),
+        additional="\n".join(additional),
+        **slot_text,
+    )
 
-def generate_parade_state_with_gemini(api_key, roster_df, date, day, month):
-    """Use Gemini API to generate parade state message."""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash', generation_config=genai.GenerationConfig(
-            temperature=0,
-        ))
+@lru_cache(maxsize=8)
+def build_system_instruction(template, reference_list):
+    """Fill the reference list into a system prompt once, reusing the same string (and its hash) on later calls."""
+    return template.format(reference_list=reference_list)
+
+def create_gemini_client():
+    """Import google-genai and create the client (blocking: google-genai is the slowest import).
     
-    prompt = f"""You are a military administrative assistant helping to generate a daily parade state message for a medical unit.
+    Returns:
+        Tuple of (client, types, errors), handing over the google.genai modules the callers need
+    """
+    from google import genai
+    from google.genai import errors, types
+    client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
+    return client, types, errors
 
-**INPUT DATA:**
-Date: {date} {month} 2025
-Day: {day}
+def start_gemini_client():
+    """Start creating the Gemini client in a worker thread, once, and return the task producing (client, types, errors).
+    
+    Kept off module import so startup stays fast, and off the event loop so the import doesn't stall other chats.
+    """
+    global _GEMINI_CLIENT_TASK
+    if _GEMINI_CLIENT_TASK is None:
+        _GEMINI_CLIENT_TASK = asyncio.ensure_future(asyncio.to_thread(create_gemini_client))
+    return _GEMINI_CLIENT_TASK
+
+async def get_gemini_client():
+    """Return (client, types, errors) for the Gemini client shared by all requests (authenticates once, reuses its connections)."""
+    return await asyncio.shield(start_gemini_client())
+
+async def get_context_cache(system_instruction):
+    """Return the name of a Gemini context cache holding system_instruction, or None to send it inline.
+    
+    The cache is created on first use and recreated shortly before its TTL runs out. If the instruction is
+    below the model's minimum cacheable size, None is remembered for the full TTL; other creation failures
+    (rate limits, server or network errors) are retried after CONTEXT_CACHE_RETRY_INTERVAL.
+    """
+    cached = _CONTEXT_CACHES.get(system_instruction)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    
+    # Serialise creation so concurrent first requests share one cache instead of each creating their own
+    async with _CONTEXT_CACHES_LOCK:
+        now = time.monotonic()
+        cached = _CONTEXT_CACHES.get(system_instruction)
+        if cached and now < cached[0]:
+            return cached[1]
+        
+        client, types, errors = await get_gemini_client()
+        
+        refresh_at = now + CONTEXT_CACHE_TTL - CONTEXT_CACHE_REFRESH_MARGIN
+        try:
+            cache = await client.aio.caches.create(
+                model=GEMINI_MODEL,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    ttl=f"{CONTEXT_CACHE_TTL}s",
+                ),
+            )
+            logger.info(f"Created Gemini context cache {cache.name}")
+            cache_name = cache.name
+        except Exception as e:
+            cache_name = None
+            if isinstance(e, errors.ClientError) and e.code == 400 and 'too small' in str(e).lower():
+                logger.info(f"System instruction is below the minimum cacheable size, sending it inline: {e}")
+            else:
+                logger.warning(f"Gemini context cache unavailable, sending system instruction inline for now: {e}")
+                refresh_at = now + CONTEXT_CACHE_RETRY_INTERVAL
+        
+        _CONTEXT_CACHES[system_instruction] = (refresh_at, cache_name)
+        return cache_name
+
+def drop_context_cache(system_instruction, cache_name):
+    """Forget cache_name for system_instruction so the next call recreates it (unless it was already replaced)."""
+    cached = _CONTEXT_CACHES.get(system_instruction)
+    if cached and cached[1] == cache_name:
+        del _CONTEXT_CACHES[system_instruction]
+
+async def get_generation_config(system_instruction, max_output_tokens, thinking_budget):
+    """Return a deterministic, length-capped generation config for system_instruction.
+    
+    Thinking tokens count towards max_output_tokens on 2.5 models, so the cap must include thinking_budget.
+    """
+    cache_name = await get_context_cache(system_instruction)
+    _, types, _ = await get_gemini_client()
+    
+    return types.GenerateContentConfig(
+        temperature=0,
+        candidate_count=1,
+        max_output_tokens=max_output_tokens,
+        thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
+        cached_content=cache_name,
+        system_instruction=None if cache_name else system_instruction,
+    )
+
+async def stream_gemini(prompt, system_instruction, max_output_tokens, thinking_budget=0, on_partial=None):
+    """Stream a Gemini response, awaiting on_partial with the accumulated text after each chunk.
+    
+    A response cut off by max_output_tokens is regenerated once without the cap rather than returned truncated.
+    If the context cache has gone (e.g. deleted or expired early), it is dropped and the call retried once.
+    """
+    client, types, errors = await get_gemini_client()
+    
+    for attempt in range(2):
+        config = await get_generation_config(system_instruction, max_output_tokens, thinking_budget)
+        text = ""
+        finish_reason = None
+        try:
+            async for chunk in await client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL,
+                contents=prompt,
+                config=config,
+            ):
+                text += chunk.text or ""
+                if chunk.candidates and chunk.candidates[0].finish_reason:
+                    finish_reason = chunk.candidates[0].finish_reason
+                if on_partial:
+                    await on_partial(text)
+        except errors.ClientError as e:
+            if attempt or not config.cached_content or 'cached' not in str(e).lower():
+                raise
+            logger.warning(f"Gemini context cache {config.cached_content} unusable, recreating it: {e}")
+            drop_context_cache(system_instruction, config.cached_content)
+            continue
+        break
+    
+    if finish_reason == types.FinishReason.MAX_TOKENS:
+        if max_output_tokens is None:
+            raise Exception("Gemini response was cut off at the model's output limit")
+        logger.warning(f"Gemini response hit max_output_tokens={max_output_tokens}, retrying without the cap")
+        return await stream_gemini(prompt, system_instruction, None, thinking_budget, on_partial)
+    return text
 
-Roster (Name and Duty Assignment):
-{roster_df.to_string(index=False)}
+PARADE_SYSTEM_PROMPT = """You are a military administrative assistant helping to generate a daily parade state message for a medical unit. You will be given the date, day and the roster (Name and Duty Assignment).
 
 **DUTY CODES EXPLANATION:**
 - M1, M2, M3, M4: Medic duty assignments
@@ -341,7 +756,7 @@ Roster (Name and Duty Assignment):
 **OUTPUT FORMAT:**
 Generate EXACTLY this format:
 
-PARADE STATE FOR {date} {month} 2025 {day}
+PARADE STATE FOR [DATE] [MONTH] 2025 [DAY]
 
 Holding Strength: 17
 Present Strength: [calculate]/[holding strength]
@@ -388,55 +803,67 @@ Flying Hours: TBC
 - Only update the Medics, M1-M4, and Additional sections based on the roster data
 - Ensure all names are sorted by rank within each section
 - Preserve leave duration information in the format shown in the roster
+- Use the rank and full name from the reference list below for every medic you list, and sort by the corrected rank
 - Do not add any extra commentary or explanation, just output the parade state message
+
+**REFERENCE LIST OF MEDICS (Correct Full Names and Updated Ranks):**
+{reference_list}
 """
-    
-    response = model.generate_content(prompt)
-    return response.text
+PARADE_PROMPT_TEMPLATE = """Date: {date} {month} 2025
+Day: {day}
 
-def prepare_c1_c5_data(df, target_date_col):
-    """Extract C1/C5 duty data for previous and current day."""
-    target_data = df.iloc[5:21, [1, target_date_col - 1, target_date_col]].copy().reset_index(drop=True)
-    target_data.columns = ['Name', 'Previous Day Duty', 'Current Day Duty']
-    return target_data
+Roster (pipe-separated Name|Duty):
+{roster}"""
 
-def fill_c1_c5_with_gemini(api_key, parade_state, c1_c5_df):
-    """Use Gemini API to fill in C1 and C5 personnel in parade state."""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash', generation_config=genai.GenerationConfig(
-            temperature=0,
-        ))
+async def generate_parade_state_with_gemini(roster_df, date, day, month, reference_list, on_partial=None):
+    """Use Gemini API to generate the parade state with corrected medic names/ranks in a single call.
     
-    prompt = f"""You are an administrative assistant in charge of identifying the C1 and C5 personnel for a military unit based on a duty roster.
-
-Look at the following duty roster (previous day and current day) and identify the C1 and C5 personnel for the current day (second column). If it is not stated explicitly, then the previous day C1 will be the current day C5.
-
-ROSTER:
-{c1_c5_df.to_string(index=False)}
-
-Fill in the C1 and C5 personnel rank and name in the parade state message below. Just output the completed message without any extra commentary or explanation.
+    Fallback for when the roster can't be classified locally.
+    """
+    # The reference list is the same on every call, so it travels with the cached system instruction
+    system_instruction = build_system_instruction(PARADE_SYSTEM_PROMPT, reference_list)
+    prompt = PARADE_PROMPT_TEMPLATE.format(
+        date=date,
+        month=month,
+        day=day,
+        roster=roster_df.to_csv(sep='|', index=False, header=False, na_rep='NaN', lineterminator='\n'),
+    )
+    return await stream_gemini(prompt, system_instruction, PARADE_MAX_OUTPUT_TOKENS, PARADE_THINKING_BUDGET, on_partial)
 
-{parade_state}
-"""
+def prepare_c1_c5_data(df, target_date_col):
+    """Identify today's C1 and C5 personnel from previous and current day duties.
     
-    response = model.generate_content(prompt)
-    return response.text
-
-def correct_medic_names_ranks(api_key, parade_state, reference_list):
-    """Use Gemini API to correct medic names and ranks in parade state."""
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash', generation_config=genai.GenerationConfig(
-            temperature=0,
-        ))
+    C5 is taken from today's column when assigned explicitly, otherwise yesterday's C1 becomes today's C5.
+    
+    Returns:
+        Tuple of (c1_name, c5_name), empty strings when not found
+    """
+    # Plain lists for 16 rows: cheaper than building masks and frames
+    names = df.iloc[5:21, 1].tolist()
+    previous = df.iloc[5:21, target_date_col - 1].tolist()
+    current = df.iloc[5:21, target_date_col].tolist()
     
-    prompt = f"""You are an administrative assistant in charge of verifying and correcting medic names and ranks in a military parade state message.
+    def first_name(duties, code):
+        for name, duty in zip(names, duties):
+            if not pd.isna(name) and str(duty).strip().upper() == code:
+                return str(name).strip()
+        return ""
+    
+    c1 = first_name(current, 'C1')
+    c5 = first_name(current, 'C5') or first_name(previous, 'C1')
+    return c1, c5
 
-**REFERENCE LIST OF MEDICS (Correct Full Names and Updated Ranks):**
-{reference_list}
+def fill_c1_c5(parade_state, c1, c5):
+    """Fill in the C1 and C5 lines of the parade state."""
+    parade_state = re.sub(r'^C1:.*$', lambda _: f"C1: {c1}", parade_state, count=1, flags=re.MULTILINE)
+    parade_state = re.sub(r'^C5:.*$', lambda _: f"C5: {c5}", parade_state, count=1, flags=re.MULTILINE)
+    return parade_state
+
+CORRECTION_SYSTEM_PROMPT = """You are an administrative assistant in charge of verifying and correcting medic names and ranks in a military parade state message. You will be given a parade state message to check against the reference list of medics (correct full names and updated ranks) below.
 
 **YOUR TASK:**
-1. Review the "Medics:" section, "M1-M4" sections, and "Additional:" section in the parade state below
-2. Match the names in the parade state with the reference list above
+1. Review the "Medics:" section, "M1-M4" sections, and "Additional:" section in the parade state
+2. Match the names in the parade state with the reference list
 3. Correct any discrepancies in:
    - Rank (ensure it matches the reference list)
    - Name (ensure full names are used as per reference list)
@@ -444,38 +871,125 @@ def correct_medic_names_ranks(api_key, parade_state, reference_list):
 5. Do NOT modify any other sections (MO, SM, C1, C5, BASE E, SUPPLY ASSISTANT, Flying Hours)
 6. Only correct medic-related entries
 
-{parade_state}
-
 Output the corrected parade state message with accurate medic names and ranks. Do not add any extra commentary or explanation.
+
+**REFERENCE LIST OF MEDICS (Correct Full Names and Updated Ranks):**
+{reference_list}
+"""
+CORRECTION_PROMPT_TEMPLATE = """**PARADE STATE:**
+{parade_state}
 """
+
+async def correct_medic_names_ranks(parade_state, reference_list, on_partial=None):
+    """Use Gemini API to correct medic names and ranks in parade state."""
+    # The reference list is the same on every call, so it travels with the cached system instruction
+    system_instruction = build_system_instruction(CORRECTION_SYSTEM_PROMPT, reference_list)
+    prompt = CORRECTION_PROMPT_TEMPLATE.format(parade_state=parade_state)
     
-    response = model.generate_content(prompt)
-    return response.text
+    # Correcting names against a list is a lookup, so the pass runs without thinking
+    return await stream_gemini(prompt, system_instruction, CORRECTION_MAX_OUTPUT_TOKENS, 0, on_partial)
 
-def process_full_parade_state(main_csv_url, c1_c5_csv_url, api_key, reference_list, target_date_col, date, spreadsheet_id, sheet_id, credentials_json):
-    """Generate complete parade state with leave info, C1, C5, and corrected medic names/ranks."""
-    # Step 1: Fetch main roster and prepare initial data
-    csv_data = fetch_csv_from_url(main_csv_url)
-    df = pd.read_csv(csv_data, header=None)
-    date_num, day = extract_date_info(df, target_date_col)
-    roster_df, month = prepare_roster_data(df, target_date_col)
+async def process_full_parade_state(http_client, main_csv_url, c1_c5_csv_url, reference_list, target_date_col, date, spreadsheet_id, sheet_id, credentials_json, sheet_title=None, on_partial=None):
+    """Generate complete parade state with leave info, C1, C5, and corrected medic names/ranks.
     
-    # Step 2: Update roster with leave information (using same spreadsheet and selected sheet)
-    roster_df = update_roster_with_leave_info(roster_df, date, month, spreadsheet_id, sheet_id, credentials_json)
+    on_partial, if given, is awaited with the accumulated text as the final pass streams in.
     
-    # Step 3: Generate initial parade state with updated roster
-    initial_parade_state = generate_parade_state_with_gemini(api_key, roster_df, date_num, day, month)
+    Returns:
+        Tuple of (parade_state, leave_applied); leave_applied is False when the leave sheet couldn't be read,
+        but True when leave tracking isn't configured, since retrying can't improve on that
+    """
+    def start_leave_tracker():
+        return asyncio.create_task(get_leave_tracker(spreadsheet_id, sheet_id, credentials_json, sheet_title))
     
-    # Step 4: Fetch C1/C5 data and fill in C1 and C5
-    csv_data = fetch_csv_from_url(c1_c5_csv_url)
-    df = pd.read_csv(csv_data, header=None)
-    c1_c5_df = prepare_c1_c5_data(df, target_date_col)
-    parade_state_with_c1_c5 = fill_c1_c5_with_gemini(api_key, initial_parade_state, c1_c5_df)
+    # Start loading the leave sheet now so its gspread round-trips overlap the CSV downloads, unless everyone
+    # already has a duty (handle_date has usually just cached the main CSV, so this is known up front)
+    cached = _CSV_CACHE.get(main_csv_url)
+    if not credentials_json:
+        tracker_task = None
+        logger.warning("GOOGLE_CREDENTIALS_JSON not set. Skipping leave tracking.")
+    elif cached is None or has_unassigned_personnel(prepare_roster_data(cached[1], target_date_col)[0]):
+        tracker_task = start_leave_tracker()
+    else:
+        tracker_task = None
+        logger.info("Everyone has a duty, skipping the leave sheet")
     
-    # Step 5: Correct medic names and ranks using reference list
-    final_parade_state = correct_medic_names_ranks(api_key, parade_state_with_c1_c5, reference_list)
+    try:
+        # Step 1: Fetch both rosters concurrently (once if C1/C5 share the main sheet) and prepare initial data
+        if c1_c5_csv_url == main_csv_url:
+            df = c1_c5_raw = await get_dataframe(http_client, main_csv_url)
+        else:
+            df, c1_c5_raw = await asyncio.gather(
+                get_dataframe(http_client, main_csv_url),
+                get_dataframe(http_client, c1_c5_csv_url),
+            )
+        date_num, day = extract_date_info(df, target_date_col)
+        roster_df, month = prepare_roster_data(df, target_date_col)
+        c1, c5 = prepare_c1_c5_data(c1_c5_raw, target_date_col)
+        
+        # Step 2: Update roster with leave information (using same spreadsheet and selected sheet)
+        leave_applied = True
+        if credentials_json and has_unassigned_personnel(roster_df):
+            if tracker_task is None:  # The cached CSV was refreshed with new gaps in the meantime
+                tracker_task = start_leave_tracker()
+            roster_df, leave_applied = update_roster_with_leave_info(roster_df, date, month, await tracker_task)
+        
+        # Step 3: Generate the parade state with medic names and ranks corrected against the reference list.
+        # C1/C5 are left blank by Gemini, so they are merged into every streamed partial and the final text
+        async def show_partial_with_c1_c5(text):
+            await on_partial(fill_c1_c5(text, c1, c5))
+        
+        stream_callback = show_partial_with_c1_c5 if on_partial else None
+        initial_parade_state = build_parade_state(roster_df, date_num, day, month)
+        if initial_parade_state is None:
+            logger.info("Falling back to Gemini for the parade state")
+            corrected_parade_state = await generate_parade_state_with_gemini(
+                roster_df, date_num, day, month, reference_list, stream_callback
+            )
+        else:
+            corrected_parade_state = await correct_medic_names_ranks(
+                initial_parade_state, reference_list, stream_callback
+            )
+        
+        # Step 4: Fill in C1 and C5
+        final_parade_state = fill_c1_c5(corrected_parade_state, c1, c5)
+        
+        return final_parade_state, leave_applied
+    except Exception:
+        # Reload the leave sheet on the next attempt rather than reusing a copy from a failed run
+        _LEAVE_TRACKER_CACHE.pop((spreadsheet_id, sheet_id), None)
+        raise
+
+async def get_parade_state_coalesced(key, make_coro):
+    """Run make_coro() once per key, sharing the result with concurrent and recent callers.
     
-    return final_parade_state
+    make_coro() must return (parade_state, leave_applied). Results built without leave info are only reused
+    briefly, so a transient leave sheet failure isn't served to everyone for the full TTL.
+    """
+    cached = _PARADE_STATE_CACHE.get(key)
+    if cached and time.monotonic() < cached[0]:
+        _PARADE_STATE_CACHE_STATS['hits'] += 1
+        logger.info(f"Parade state cache hit for {key} ({_PARADE_STATE_CACHE_STATS})")
+        return cached[1]
+    
+    task = _PARADE_STATE_INFLIGHT.get(key)
+    if task is None:
+        _PARADE_STATE_CACHE_STATS['misses'] += 1
+        logger.info(f"Parade state cache miss for {key} ({_PARADE_STATE_CACHE_STATS})")
+        task = asyncio.ensure_future(make_coro())
+        _PARADE_STATE_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _PARADE_STATE_INFLIGHT.pop(key, None))
+    else:
+        _PARADE_STATE_CACHE_STATS['joins'] += 1
+        logger.info(f"Joining in-flight parade state generation for {key} ({_PARADE_STATE_CACHE_STATS})")
+    
+    parade_state, leave_applied = await asyncio.shield(task)
+    now = time.monotonic()
+    # Entries for superseded sheet contents are never hit again, so drop expired ones as we go
+    for stale_key in [k for k, (expires_at, _) in _PARADE_STATE_CACHE.items() if now >= expires_at]:
+        del _PARADE_STATE_CACHE[stale_key]
+    ttl = PARADE_STATE_CACHE_TTL if leave_applied else PARTIAL_PARADE_STATE_CACHE_TTL
+    _PARADE_STATE_CACHE[key] = (now + ttl, parade_state)
+    return parade_state
 
 # Telegram Bot Handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -490,6 +1004,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Commands:\n"
         "/generate - Start generating a parade state\n"
         "/help - Show usage instructions\n"
+        "/refresh_sheets - Reload the sheet lists (e.g. after adding a new month)\n"
         "/cancel - Cancel current operation"
     )
     await update.message.reply_text(welcome_message)
@@ -505,16 +1020,29 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "4. Enter a date number (1-31)\n"
         "5. Wait for processing\n"
         "6. Receive your formatted parade state\n\n"
-        "You can cancel anytime with /cancel\n\n"
+        "You can cancel anytime with /cancel\n"
+        "New sheet not listed? Send /refresh_sheets\n\n"
         "Need help? Contact your administrator."
     )
     await update.message.reply_text(help_message)
 
+async def refresh_sheets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop the cached sheet listings so the next /generate fetches them again."""
+    _SHEET_NAMES_CACHE.clear()
+    await update.message.reply_text(
+        "🔄 Sheet lists will be reloaded on the next /generate."
+    )
+
 async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the parade state generation process."""
     try:
-        # Fetch sheets from main spreadsheet
-        sheets = get_sheet_names(MAIN_SPREADSHEET_ID, GOOGLE_SHEETS_API_KEY)
+        # Fetch sheets from both spreadsheets in parallel; the C1/C5 list is kept for step 2
+        sheets, c1c5_sheets = await asyncio.gather(
+            get_sheet_names(context.bot_data['http'], MAIN_SPREADSHEET_ID, GOOGLE_SHEETS_API_KEY),
+            get_sheet_names(context.bot_data['http'], C1_C5_SPREADSHEET_ID, GOOGLE_SHEETS_API_KEY),
+        )
+        context.user_data['main_sheets'] = sheets
+        context.user_data['c1c5_sheets'] = c1c5_sheets
         
         # Create inline keyboard with sheet options
         keyboard = []
@@ -546,12 +1074,17 @@ async def main_sheet_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     # Extract sheet ID from callback data
-    sheet_id = query.data.replace("main_", "")
+    sheet_id = query.data.removeprefix("main_")
     context.user_data['main_sheet_id'] = sheet_id
+    # Keep the title too, so the leave sheet can be read by range without looking it up again
+    main_sheets = context.user_data.pop('main_sheets', [])
+    context.user_data['main_sheet_title'] = next((sheet['name'] for sheet in main_sheets if str(sheet['id']) == sheet_id), None)
     
     try:
-        # Fetch sheets from C1/C5 spreadsheet
-        sheets = get_sheet_names(C1_C5_SPREADSHEET_ID, GOOGLE_SHEETS_API_KEY)
+        # Use the C1/C5 sheets prefetched by /generate, fetching them only if missing
+        sheets = context.user_data.pop('c1c5_sheets', None)
+        if sheets is None:
+            sheets = await get_sheet_names(context.bot_data['http'], C1_C5_SPREADSHEET_ID, GOOGLE_SHEETS_API_KEY)
         
         # Create inline keyboard with sheet options
         keyboard = []
@@ -584,7 +1117,7 @@ async def c1c5_sheet_selected(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     # Extract sheet ID from callback data
-    sheet_id = query.data.replace("c1c5_", "")
+    sheet_id = query.data.removeprefix("c1c5_")
     context.user_data['c1c5_sheet_id'] = sheet_id
     
     await query.edit_message_text(
@@ -606,16 +1139,10 @@ async def handle_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return SELECTING_DATE
         
-        # Send processing message
-        processing_msg = await update.message.reply_text(
-            f"⏳ Generating parade state for {CURRENT_MONTH} {date}...\n"
-            "Checking leave status and processing roster...\n"
-            "Please wait a moment."
-        )
-        
         # Get selected sheet IDs
         main_sheet_id = context.user_data.get('main_sheet_id')
         c1c5_sheet_id = context.user_data.get('c1c5_sheet_id')
+        main_sheet_title = context.user_data.get('main_sheet_title')
         
         # Build CSV URLs
         main_csv_url = build_csv_url(MAIN_SPREADSHEET_ID, main_sheet_id)
@@ -624,24 +1151,82 @@ async def handle_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Calculate column index
         target_column = date + 2
         
+        # Reject dates the sheet doesn't cover before any Gemini work (the frame is cached for the pipeline)
+        df = await get_dataframe(context.bot_data['http'], main_csv_url)
+        if target_column >= df.shape[1] or not str(df.iat[2, target_column]).strip().upper().startswith(WEEKDAYS):
+            await update.message.reply_text(
+                "❌ The roster doesn't cover that date yet. Please enter another date."
+            )
+            return SELECTING_DATE
+        
+        # Send processing message
+        processing_msg = await update.message.reply_text(
+            f"⏳ Generating parade state for {CURRENT_MONTH} {date}...\n"
+            "Checking leave status and processing roster...\n"
+            "Please wait a moment."
+        )
+        
+        # Show the parade state as it streams in, throttled to stay within Telegram's edit limits
+        shown_text = None
+        last_edit = 0.0
+        edit_task = None
+        
+        async def edit_partial(text):
+            nonlocal shown_text
+            try:
+                await processing_msg.edit_text(text)
+                shown_text = text
+            except TelegramError as e:
+                # Progress edits are cosmetic: a failure here must not abort the (possibly shared) generation
+                logger.warning(f"Skipping progressive edit: {e}")
+        
+        async def show_partial(text):
+            nonlocal last_edit, edit_task
+            now = time.monotonic()
+            if now - last_edit < STREAM_EDIT_INTERVAL or not text.strip() or text == shown_text:
+                return
+            # Fire and forget, skipping partials while an edit is still pending: the rate limiter can hold an
+            # edit for a minute or more, and the stream (and everyone sharing it) mustn't wait on that
+            if edit_task is not None and not edit_task.done():
+                return
+            last_edit = now
+            edit_task = asyncio.create_task(edit_partial(text))
+        
         # Generate complete parade state (with leave info, C1, C5, and corrected names/ranks)
         # Use same spreadsheet and sheet as main roster for leave tracking
-        parade_state = process_full_parade_state(
-            main_csv_url, 
-            c1c5_csv_url, 
-            GEMINI_API_KEY,
-            MEDICS_REFERENCE_LIST,
-            target_column,
-            date,
-            MAIN_SPREADSHEET_ID,  # Same spreadsheet as main roster
-            int(main_sheet_id),   # Same sheet ID as main roster
-            GOOGLE_CREDENTIALS_JSON
+        # Requests for the same sheets, contents and date share one generation
+        sheet_data_hash = await get_sheet_data_hash(context.bot_data['http'], main_csv_url, c1c5_csv_url)
+        parade_state = await get_parade_state_coalesced(
+            (main_sheet_id, c1c5_sheet_id, date, sheet_data_hash),
+            lambda: process_full_parade_state(
+                context.bot_data['http'],
+                main_csv_url, 
+                c1c5_csv_url, 
+                MEDICS_REFERENCE_LIST,
+                target_column,
+                date,
+                MAIN_SPREADSHEET_ID,  # Same spreadsheet as main roster
+                int(main_sheet_id),   # Same sheet ID as main roster
+                GOOGLE_CREDENTIALS_JSON,
+                sheet_title=main_sheet_title,
+                on_partial=show_partial
+            )
         )
         
-        # Send the result
-        await processing_msg.edit_text(
-            f"{parade_state}"
-        )
+        # Drop any progress edit still waiting on the rate limiter so it can't land after the result
+        if edit_task is not None:
+            edit_task.cancel()
+        
+        # Send the result (skipped if the last progressive edit already shows it; Telegram strips
+        # surrounding whitespace, so texts differing only there count as the same)
+        if shown_text is None or parade_state.strip() != shown_text.strip():
+            try:
+                await processing_msg.edit_text(
+                    f"{parade_state}"
+                )
+            except BadRequest as e:
+                if "message is not modified" not in str(e).lower():
+                    raise
         
         # Clear user data
         context.user_data.clear()
@@ -673,10 +1258,78 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Log errors caused by updates."""
     logger.error(f"Update {update} caused error {context.error}")
 
+class OrjsonRequest(HTTPXRequest):
+    """Telegram request backend that parses responses with orjson."""
+    
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError as exc:
+            logger.exception(f'Can not load invalid JSON data: "{payload!r}"')
+            raise TelegramError("Invalid server response") from exc
+
+async def post_init(application: Application):
+    """Create the shared HTTP client once the event loop is running.
+    
+    All Google Sheets traffic (sheet listings and CSV exports) goes through it, so TLS connections are kept alive and reused.
+    Failed connection attempts are retried so a dropped keep-alive connection doesn't fail the request.
+    The Gemini client is warmed up in the background so the first generation doesn't wait for its import.
+    """
+    start_gemini_client()
+    application.bot_data['http'] = httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=10),
+            retries=HTTP_CONNECT_RETRIES,
+        ),
+    )
+
+async def post_shutdown(application: Application):
+    """Close the shared HTTP client."""
+    http_client = application.bot_data.pop('http', None)
+    if http_client is not None:
+        await http_client.aclose()
+
+class LogFormatter(logging.Formatter):
+    """Log INFO and below with a millisecond offset from startup, and WARNING and above with a full timestamp.
+    
+    The offset needs no strftime call, which keeps the per-record cost down on busy INFO paths.
+    """
+    
+    def __init__(self):
+        super().__init__('%(relativeCreated)d - %(name)s - %(levelname)s - %(message)s')
+        self.timestamped = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    
+    def format(self, record):
+        if record.levelno >= logging.WARNING:
+            return self.timestamped.format(record)
+        return super().format(record)
+
 def main():
     """Start the bot."""
-    # Create the Application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Configure logging
+    handler = logging.StreamHandler()
+    handler.setFormatter(LogFormatter())
+    logging.basicConfig(handlers=[handler], level=logging.INFO)
+    # httpx logs every request at INFO, which adds a record per Telegram call and streamed edit
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    # Create the Application: updates from different chats are processed concurrently, with room
+    # for concurrent edits and Telegram's 30 msg/s bot-wide limit
+    request_class = OrjsonRequest if orjson else HTTPXRequest
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .request(request_class(connection_pool_size=64, pool_timeout=30))
+        .get_updates_request(request_class(connection_pool_size=8))
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Create conversation handler
     conv_handler = ConversationHandler(
@@ -684,7 +1337,8 @@ def main():
         states={
             SELECTING_MAIN_SHEET: [CallbackQueryHandler(main_sheet_selected)],
             SELECTING_C1C5_SHEET: [CallbackQueryHandler(c1c5_sheet_selected)],
-            SELECTING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_date)]
+            # Generation takes several seconds; run it as a task so other updates keep being dispatched
+            SELECTING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_date, block=False)]
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
@@ -692,14 +1346,26 @@ def main():
     # Register handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("refresh_sheets", refresh_sheets_command))
     application.add_handler(conv_handler)
     
     # Register error handler
     application.add_error_handler(error_handler)
     
-    # Start the Bot
-    logger.info("Bot is starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Start the Bot, only subscribing to the update types the handlers use
+    allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+    if WEBHOOK_URL:
+        logger.info(f"Bot is starting with a webhook on port {PORT}...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            allowed_updates=allowed_updates,
+        )
+    else:
+        logger.info("Bot is starting...")
+        application.run_polling(allowed_updates=allowed_updates)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file